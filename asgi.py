@@ -0,0 +1,373 @@
+"""
+ASGI serving mode.
+
+The routes that spend their time waiting on PostgreSQL -- the patient
+chart, the reports and the /api/v1 endpoints -- run natively on asyncio
+with SQLAlchemy's async engine (asyncpg), so a slow report holds a
+coroutine instead of a thread, and independent queries (the chart
+sections, the two report types) run concurrently on separate
+connections. Every other route, and the ?format= exports of the native
+report pages, is the Flask app from server.py, mounted as WSGI and run in
+a thread pool. Configuration is server.py's.
+
+    pip install -r requirements-asgi.txt
+    python asgi.py --workers 4                  # or: uvicorn asgi:app
+
+Thread mode (python server.py --threaded) is unchanged.
+"""
+import asyncio
+import json
+import time
+from functools import wraps
+
+import click
+from a2wsgi import WSGIMiddleware
+from flask import render_template
+from sqlalchemy import exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.datastructures import QueryParams
+from starlette.routing import Mount, Route, request_response
+
+import server
+from server import (API_MAX_PAGE_SIZE, API_PAGE_SIZE, API_RESOURCES, CHART_SECTIONS,
+                    CHART_TABLES, CONFLICT_INDEX_WAIT, MISS, PATIENT_CHART_SQL, REPORT_TYPES,
+                    ApiError, api_query, chart_etag, json_default, report_period, report_sql)
+
+flask_app = server.create_app()
+
+# created in lifespan(), one per worker process
+engine = None
+
+
+def make_async_engine(config):
+    url = make_url(config["DATABASE_URI"])
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+    if config["DB_POOL"] == "null":
+        eng = create_async_engine(url, poolclass=NullPool)
+    else:
+        eng = create_async_engine(
+            url,
+            pool_size=config["DB_POOL_SIZE"],
+            max_overflow=config["DB_MAX_OVERFLOW"],
+            pool_timeout=config["DB_POOL_TIMEOUT"],
+            pool_recycle=config["DB_POOL_RECYCLE"],
+            pool_pre_ping=config["DB_POOL_PRE_PING"],
+        )
+    # same pool counters and slow query log as the thread mode engine
+    server.instrument_engine(eng.sync_engine)
+    return eng
+
+
+async def fetch(request, sql, params=None):
+    """
+    Run one query on its own pooled connection and return all rows. Separate
+    connections are what lets asyncio.gather() run queries side by side.
+    """
+    start = time.perf_counter()
+    async with engine.connect() as conn:
+        rows = (await conn.execute(text(sql), params or {})).fetchall()
+    db = request.state.db
+    db["time"] += time.perf_counter() - start
+    db["queries"] += 1
+    db["rows"] += len(rows)
+    return rows
+
+
+def timed(endpoint):
+    """Server-Timing header and /metrics counters, like server.record_request."""
+    def decorate(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            request.state.db = {"time": 0.0, "queries": 0, "rows": 0}
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                db = request.state.db
+                response.headers["Server-Timing"] = server.server_timing(
+                    time.perf_counter() - start, db["time"], db["queries"])
+                return response
+            finally:
+                db = request.state.db
+                server.observe_request(endpoint, request.method, status, time.perf_counter() - start,
+                                       db["time"], db["queries"], db["rows"])
+        return wrapper
+    return decorate
+
+
+def render(request, template, status_code=200, **context):
+    """Render one of server.py's templates (they need a Flask request context for url_for)."""
+    with flask_app.test_request_context(request.url.path, query_string=request.url.query):
+        return HTMLResponse(render_template(template, **context), status_code=status_code)
+
+
+def int_arg(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        return default
+
+
+def not_modified(request, etag):
+    """Does the client's If-None-Match already cover `etag`?"""
+    header = request.headers.get("if-none-match", "")
+    tags = {t.strip().removeprefix("W/").strip('"') for t in header.split(",")}
+    return etag in tags or "*" in tags
+
+
+def conditional(request, response, etag):
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+async def patient_chart(request, patient_id):
+    """
+    Same document, cache entry and ETag as server.patient_chart, but on a
+    miss the sections are fetched concurrently.
+    """
+    params = {"pid": patient_id}
+    key = server.cache_key(PATIENT_CHART_SQL, params)
+    # the cache may be Redis, keep its round trip off the event loop
+    rows = await asyncio.to_thread(server.cache_get, "patient_chart", key)
+    if rows is MISS:
+        results = await asyncio.gather(*(fetch(request, f"SELECT {sql}", params)
+                                         for sql in CHART_SECTIONS.values()))
+        chart = {}
+        for name, section in zip(CHART_SECTIONS, results):
+            value = section[0][0]
+            # asyncpg hands json back as text
+            chart[name] = json.loads(value) if isinstance(value, str) else value
+        if chart["patient"] is None:
+            return None, None
+        await asyncio.to_thread(server.cache_set, "patient_chart", key, [(chart,)], CHART_TABLES)
+    else:
+        chart = rows[0][0]
+        if isinstance(chart, str):
+            chart = json.loads(chart)
+        if not chart or chart["patient"] is None:
+            return None, None
+    return chart, chart_etag(chart)
+
+
+@timed("patient_chart_view")
+async def patient_chart_view(request):
+    chart, etag = await patient_chart(request, request.path_params["patient_id"])
+    if chart is None:
+        return render(request, "error.html", 404, message="The page or resource you requested was not found.")
+    if not_modified(request, etag):
+        return conditional(request, Response(status_code=304), etag)
+    return conditional(request, render(request, "patient_chart.html", chart=chart), etag)
+
+
+@timed("patient_chart_api")
+async def patient_chart_api(request):
+    chart, etag = await patient_chart(request, request.path_params["patient_id"])
+    if chart is None:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    if not_modified(request, etag):
+        return conditional(request, Response(status_code=304), etag)
+    return conditional(request, JSONResponse(chart), etag)
+
+
+async def report_rows(request, view, rest, params=None, live=False, period=None):
+    """server.report_rows: the view (and when it was refreshed), or the live query."""
+    server.ensure_report_refresher()
+    if period:
+        sql = f"SELECT * FROM ({report_sql(view, period=True)}) AS r {rest}"
+        return await fetch(request, sql, {**(params or {}), **period}), None
+    if not live:
+        try:
+            rows, refreshed = await asyncio.gather(
+                fetch(request, f"SELECT * FROM {view} {rest}", params),
+                fetch(request, "SELECT refreshed_at FROM report_refresh WHERE view_name = :v", {"v": view}),
+            )
+            return rows, refreshed[0][0] if refreshed else None
+        except (exc.ProgrammingError, exc.OperationalError) as e:
+            print(f"{view} is not available, computing the report live (run init-db):", e)
+    sql = f"SELECT * FROM ({report_sql(view)}) AS r {rest}"
+    return await fetch(request, sql, params), None
+
+
+@timed("reports")
+async def reports(request):
+    form = await request.form() if request.method == "POST" else {}
+    args = {**request.query_params, **form}
+    report_type = args.get("report_type")
+    live = args.get("live") == "1"
+    period, dates = report_period(args)
+    results, as_of = [], None
+    if report_type in REPORT_TYPES:
+        results, as_of = await report_rows(request, *REPORT_TYPES[report_type], live=live,
+                                           period=period)
+    return render(request, "report.html", report_type=report_type, results=results,
+                  live=live, as_of=as_of, dates=dates)
+
+
+@timed("report_rx_counts")
+async def report_rx_counts(request):
+    min_ct = int_arg(request.query_params, "min", 1)
+    live = request.query_params.get("live") == "1"
+    period, dates = report_period(request.query_params)
+    rows, as_of = await report_rows(request, "report_rx_counts_mv", server.RX_COUNTS_REST, {"m": min_ct},
+                                    live=live, period=period)
+    return render(request, "report_rx_counts.html", rows=rows, min=min_ct, live=live, as_of=as_of,
+                  dates=dates)
+
+
+@timed("reports_api")
+async def reports_api(request):
+    """Both report types, queried concurrently."""
+    live = request.query_params.get("live") == "1"
+    period, _ = report_period(request.query_params)
+    results = await asyncio.gather(*(report_rows(request, view, order, live=live, period=period)
+                                     for view, order in REPORT_TYPES.values()))
+    body = {report_type: {"as_of": as_of, "rows": [row._asdict() for row in rows]}
+            for report_type, (rows, as_of) in zip(REPORT_TYPES, results)}
+    return Response(json.dumps(body, default=json_default), media_type="application/json")
+
+
+@timed("api_list")
+async def api_list(request):
+    """server.api_list, with NDJSON streamed from an async server-side cursor."""
+    resource = API_RESOURCES.get(request.path_params["name"])
+    if resource is None:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    args = request.query_params
+    try:
+        sql, params, fields = api_query(resource, args)
+    except ApiError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    n_key = len(resource["key"])
+
+    ndjson = (args.get("format") == "ndjson"
+              or request.headers.get("accept", "").split(",")[0].strip() == "application/x-ndjson")
+    if ndjson:
+        if "limit" in args:
+            sql += " LIMIT :limit"
+            params["limit"] = max(1, int_arg(args, "limit", API_PAGE_SIZE))
+
+        async def lines():
+            async with engine.connect() as conn:
+                result = await conn.stream(text(sql), params)
+                async for row in result:
+                    yield json.dumps(dict(zip(fields, row[n_key:])), default=json_default) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    limit = max(1, min(int_arg(args, "limit", API_PAGE_SIZE), API_MAX_PAGE_SIZE))
+    sql += " LIMIT :limit"
+    params["limit"] = limit + 1
+    rows = await fetch(request, sql, params)
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = ",".join(str(v) for v in rows[-1][:n_key])
+    body = {"data": [dict(zip(fields, row[n_key:])) for row in rows], "next": next_after}
+    return Response(json.dumps(body, default=json_default), media_type="application/json")
+
+
+@timed("conflict_check")
+async def conflict_check(request):
+    """server.conflict_check; the index is in memory, only the first build is waited for."""
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    batch = isinstance(body, dict) and "prescriptions" in body
+    items = body["prescriptions"] if batch else [body]
+    if not isinstance(items, list) or len(items) > server.CONFLICT_BATCH_MAX:
+        return JSONResponse({"error": f"prescriptions must be a list of at most {server.CONFLICT_BATCH_MAX}"},
+                            status_code=400)
+    try:
+        checks = [server.conflict_check_item(item) for item in items]
+    except (KeyError, TypeError, ValueError):
+        return JSONResponse({"error": 'expected {"patient_id": <int>, "med_ids": [<int>, ...]}'},
+                            status_code=400)
+
+    index = server.ensure_conflict_index()
+    if not index.ready.is_set() and not await asyncio.to_thread(index.ready.wait, CONFLICT_INDEX_WAIT):
+        return render(request, "error.html", 503,
+                      message="The database is unavailable right now. Please try again shortly.")
+    results = [{"patient_id": patient_id, "conflicts": index.check(patient_id, med_ids)}
+               for patient_id, med_ids in checks]
+    return JSONResponse({"results": results} if batch else results[0])
+
+
+async def db_unavailable(request, e):
+    # pool exhausted or database down, same answer as server.db_unavailable
+    print("database unavailable:", e)
+    return render(request, "error.html", 503,
+                  message="The database is unavailable right now. Please try again shortly.")
+
+
+# the Flask app, in a thread pool
+flask_wsgi = WSGIMiddleware(flask_app, workers=32)
+
+
+class FlaskExports:
+    """A native route that hands ?format= requests to Flask's streaming export()."""
+
+    def __init__(self, endpoint):
+        self.native = request_response(endpoint)
+
+    async def __call__(self, scope, receive, send):
+        if "format" in QueryParams(scope["query_string"]):
+            await flask_wsgi(scope, receive, send)
+        else:
+            await self.native(scope, receive, send)
+
+
+async def lifespan(app):
+    global engine
+    engine = make_async_engine(flask_app.config)
+    server.ensure_conflict_index()
+    yield
+    await engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route("/patient/{patient_id:int}", patient_chart_view),
+        Route("/api/v1/patients/{patient_id:int}/chart", patient_chart_api),
+        Route("/reports", FlaskExports(reports), methods=["GET", "POST"]),
+        Route("/reports/rx_counts", FlaskExports(report_rx_counts)),
+        Route("/api/v1/reports", reports_api),
+        Route("/api/v1/conflicts/check", conflict_check, methods=["POST"]),
+        Route("/api/v1/{name}", api_list),
+        # everything else
+        Mount("/", app=flask_wsgi),
+    ],
+    exception_handlers={exc.TimeoutError: db_unavailable, exc.DBAPIError: db_unavailable},
+    lifespan=lifespan,
+)
+
+
+@click.command()
+@click.option("--workers", default=1, show_default=True, help="worker processes")
+@click.argument("HOST", default="0.0.0.0")
+@click.argument("PORT", default=8111, type=int)
+def run(workers, host, port):
+    """
+    Run the ASGI server using:
+
+        python asgi.py --workers 4
+
+    Show the help text using:
+
+        python asgi.py --help
+    """
+    import uvicorn
+
+    print("running on %s:%d (asgi, %d workers)" % (host, port, workers))
+    uvicorn.run("asgi:app", host=host, port=port, workers=workers, log_level="warning")
+
+
+if __name__ == "__main__":
+    run()
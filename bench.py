@@ -0,0 +1,954 @@
+"""
+Benchmarks for the EHR web server.
+
+Everything here expects a throwaway local PostgreSQL, never the class
+database with real data. A typical run:
+
+    python bench.py pg-start                    # scratch cluster on port 55432
+    python bench.py generate --dsn postgresql://localhost:55432/ehr_bench --patients 100000 --reset
+    DATABASE_URI=postgresql://localhost:55432/ehr_bench python server.py --threaded &
+    python bench.py load --dsn postgresql://localhost:55432/ehr_bench \\
+        --mix search --concurrency 32 --duration 60 --output after.json
+    python bench.py compare before.json after.json
+    python bench.py pg-stop --remove
+
+Thread mode against ASGI mode (asgi.py), same mix and 500 clients each:
+
+    python bench.py modes --dsn postgresql://localhost:55432/ehr_bench --output modes.json
+
+With a streaming replica for the read-only routes:
+
+    python bench.py pg-replica                  # follows pg-start's cluster, port 55433
+    DATABASE_URI=postgresql://localhost:55432/ehr_bench \\
+        DB_REPLICA_URIS=postgresql://localhost:55433/ehr_bench python server.py --threaded &
+    python bench.py pg-stop --dir /tmp/ehr-bench-pg-replica --remove
+
+Date-bounded queries on 10 years of visits, before and after
+`flask partition-tables` (which the command runs on the database, in place):
+
+    python bench.py generate --dsn postgresql://localhost:55432/ehr_bench --patients 100000 --years 10 --reset
+    python bench.py partitions --dsn postgresql://localhost:55432/ehr_bench --output partitions.json
+
+Named statements, text() + dict rows vs. prepared + records:
+
+    python bench.py statements --dsn postgresql://localhost:55432/ehr_bench
+
+The search benchmark works in its own "bench" schema:
+
+    python bench.py search --dsn postgresql://localhost:55432/ehr_bench --rows 1000000
+
+Show the help text using:
+
+    python bench.py --help
+"""
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlencode, urlsplit
+
+import click
+from sqlalchemy import create_engine, text
+
+from server import (CONFLICT_PAIRS, PATIENT_SEARCH_EXPR, QUERIES, VISIT_PAGE_SQL, create_app,
+                    is_partitioned, migrate, partition_tables, report_sql, seed_conflict_pairs)
+
+BENCH_SCHEMA = "bench"
+
+# same query shapes as server.py
+LIKE_SQL = """
+    SELECT patient_id, firstname, lastname
+    FROM patient
+    WHERE LOWER(firstname) LIKE LOWER(:q)
+       OR LOWER(lastname) LIKE LOWER(:q)
+       OR LOWER(contact_email) LIKE LOWER(:q)
+       OR LOWER(contact_phone) LIKE LOWER(:q)
+    ORDER BY patient_id
+    LIMIT 51
+"""
+
+TRGM_SQL = f"""
+    SELECT patient_id, firstname, lastname,
+           word_similarity(LOWER(:term), {PATIENT_SEARCH_EXPR}) AS score
+    FROM patient
+    WHERE {PATIENT_SEARCH_EXPR} LIKE LOWER(:q)
+    ORDER BY score DESC, patient_id
+    LIMIT 51
+"""
+
+SEARCH_TERMS = ["ava", "smith", "garcia", "olivia.j", "555-012", "example.com", "zzq"]
+
+FIRST_NAMES = ["Ava", "Olivia", "Liam", "Noah", "Emma", "Mia", "Lucas", "Ethan",
+               "Sofia", "Amir", "Grace", "Alan", "Ada", "Priya", "Wei", "Chen",
+               "Maria", "Jose", "Fatima", "Omar"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller",
+              "Davis", "Rodriguez", "Martinez", "Hopper", "Turing", "Lovelace",
+              "Khan", "Patel", "Nguyen", "Kim", "Lee", "Lopez", "Gonzalez"]
+SPECIALTIES = ["Family Medicine", "Internal Medicine", "Pediatrics", "Cardiology",
+               "Dermatology", "Neurology", "Psychiatry", "Orthopedics"]
+CONDITIONS = ["Asthma", "Hypertension", "Type 2 diabetes", "Acute bronchitis", "Migraine",
+              "Otitis media", "Sinusitis", "Hyperlipidemia", "Anxiety disorder", "Back pain",
+              "Dermatitis", "Urinary tract infection", "Gastroenteritis", "Pharyngitis"]
+EXTRA_DRUGS = ["Metformin", "Atorvastatin", "Albuterol", "Sertraline", "Omeprazole",
+               "Amlodipine", "Levothyroxine", "Gabapentin", "Prednisone", "Cetirizine"]
+DOSAGE_FORMS = ["tablet", "capsule", "oral suspension", "injection"]
+EXTRA_SUBSTANCES = ["Peanuts", "Latex", "Shellfish", "Eggs", "Pollen", "Iodine"]
+
+N_DIAGNOSES = 500
+
+
+def sql_array(values):
+    return "ARRAY[" + ", ".join("'%s'" % v.replace("'", "''") for v in values) + "]"
+
+
+def pick(values):
+    """SQL expression that picks a random element of `values` per row."""
+    return f"({sql_array(values)})[1 + floor(random() * {len(values)})::int]"
+
+
+def bench_engine(dsn):
+    # every connection works inside the bench schema, so the unqualified
+    # table names in the query strings above resolve to the synthetic tables
+    return create_engine(dsn, connect_args={"options": f"-csearch_path={BENCH_SCHEMA},public"})
+
+
+PATIENT_TABLE = """
+    CREATE TABLE patient (
+        patient_id serial PRIMARY KEY,
+        firstname text NOT NULL,
+        lastname text NOT NULL,
+        birthdate date,
+        sex text,
+        contact_phone text,
+        contact_email text,
+        emergency_contact_name text,
+        emergency_contact_phone text
+    )
+"""
+
+# the project schema, as far as server.py relies on it
+SCHEMA = [
+    PATIENT_TABLE,
+    """
+    CREATE TABLE provider (
+        provider_id serial PRIMARY KEY,
+        full_name text NOT NULL,
+        specialty text
+    )
+    """,
+    """
+    CREATE TABLE visit (
+        visit_id serial PRIMARY KEY,
+        patient_id integer NOT NULL REFERENCES patient ON DELETE CASCADE,
+        provider_id integer REFERENCES provider,
+        visit_date_time timestamp NOT NULL,
+        location text,
+        reason text,
+        status text
+    )
+    """,
+    """
+    CREATE TABLE diagnosis (
+        dx_code text PRIMARY KEY,
+        dx_name text NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE visit_diagnosis (
+        visit_id integer REFERENCES visit ON DELETE CASCADE,
+        dx_code text REFERENCES diagnosis,
+        PRIMARY KEY (visit_id, dx_code)
+    )
+    """,
+    """
+    CREATE TABLE prescription (
+        rx_id serial PRIMARY KEY,
+        provider_id integer REFERENCES provider,
+        visit_id integer REFERENCES visit ON DELETE CASCADE,
+        dose text,
+        route text,
+        frequency text,
+        quantity integer,
+        start_date date,
+        end_date date
+    )
+    """,
+    """
+    CREATE TABLE medication (
+        med_id serial PRIMARY KEY,
+        drug_name text NOT NULL,
+        brand_name text,
+        dosage_form text
+    )
+    """,
+    """
+    CREATE TABLE prescription_medication (
+        rx_id integer REFERENCES prescription ON DELETE CASCADE,
+        med_id integer REFERENCES medication,
+        PRIMARY KEY (rx_id, med_id)
+    )
+    """,
+    """
+    CREATE TABLE patient_allergy (
+        allergy_id serial PRIMARY KEY,
+        patient_id integer NOT NULL REFERENCES patient ON DELETE CASCADE,
+        substance text NOT NULL,
+        reaction text,
+        severity text
+    )
+    """,
+    """
+    CREATE TABLE allergyconflict (
+        allergy_id integer REFERENCES patient_allergy ON DELETE CASCADE,
+        med_id integer REFERENCES medication,
+        PRIMARY KEY (allergy_id, med_id)
+    )
+    """,
+]
+
+# children first, so they can be dropped in this order
+TABLES = ["allergyconflict", "patient_allergy", "prescription_medication", "medication",
+          "prescription", "visit_diagnosis", "diagnosis", "visit", "provider", "patient"]
+
+
+def insert_patients(conn, rows):
+    conn.execute(text(f"""
+        INSERT INTO patient (firstname, lastname, birthdate, sex, contact_phone,
+                             contact_email, emergency_contact_name, emergency_contact_phone)
+        SELECT fn, ln,
+               date '1940-01-01' + (random() * 30000)::int,
+               (ARRAY['Female', 'Male', 'Other'])[1 + (i % 3)],
+               '555-' || lpad((i % 10000000)::text, 7, '0'),
+               lower(fn) || '.' || lower(ln) || i || '@example.com',
+               'Contact ' || i,
+               '555-' || lpad(((i * 7) % 10000000)::text, 7, '0')
+        FROM (
+            SELECT i, {pick(FIRST_NAMES)} AS fn, {pick(LAST_NAMES)} AS ln
+            FROM generate_series(1, :rows) AS i
+        ) s
+    """), {"rows": rows})
+
+
+def create_patients(conn, rows):
+    conn.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+    conn.execute(text(f"CREATE SCHEMA {BENCH_SCHEMA}"))
+    conn.execute(text(PATIENT_TABLE))
+    insert_patients(conn, rows)
+    conn.execute(text("ANALYZE patient"))
+    conn.commit()
+
+
+def generate_data(conn, patients, years, seed, echo=print):
+    """
+    Fill the (empty) project tables. Everything is sized from the patient
+    count: 3 visits per patient spread over `years`, 1-2 diagnoses per
+    visit, a prescription for 4 out of 5 visits with 1-2 medications, and an
+    allergy for 3 out of 10 patients -- about 12 rows per patient in total.
+    The same seed gives the same data. Returns {table: row count}.
+    """
+    conn.execute(text("SELECT setseed(:s)"), {"s": seed})
+    providers = max(10, patients // 200)
+    visits = patients * 3
+    conflict_substances = sorted({s for s, _ in CONFLICT_PAIRS})
+    drugs = sorted({d for _, d in CONFLICT_PAIRS} | set(EXTRA_DRUGS))
+
+    echo(f"patients ({patients}) ...")
+    insert_patients(conn, patients)
+
+    echo(f"providers ({providers}) ...")
+    conn.execute(text(f"""
+        INSERT INTO provider (full_name, specialty)
+        SELECT 'Dr. ' || {pick(FIRST_NAMES)} || ' ' || {pick(LAST_NAMES)}, {pick(SPECIALTIES)}
+        FROM generate_series(1, :n)
+    """), {"n": providers})
+
+    echo("diagnoses, medications ...")
+    conn.execute(text(f"""
+        INSERT INTO diagnosis (dx_code, dx_name)
+        SELECT 'D' || lpad(i::text, 4, '0'),
+               ({sql_array(CONDITIONS)})[1 + i % {len(CONDITIONS)}] || ' (' || i || ')'
+        FROM generate_series(1, :n) AS i
+    """), {"n": N_DIAGNOSES})
+    conn.execute(text(f"""
+        INSERT INTO medication (drug_name, brand_name, dosage_form)
+        SELECT d, d || ' ' || upper(left(f, 3)), f
+        FROM unnest({sql_array(drugs)}) AS d, unnest({sql_array(DOSAGE_FORMS)}) AS f
+    """))
+
+    echo(f"visits ({visits}) ...")
+    conn.execute(text(f"""
+        INSERT INTO visit (patient_id, provider_id, visit_date_time, location, reason, status)
+        SELECT 1 + floor(random() * :patients)::int,
+               1 + floor(random() * :providers)::int,
+               date_trunc('minute', now()::timestamp - random() * make_interval(days => 365 * :years)),
+               {pick(["Clinic A", "Clinic B", "Main Hospital", "Telehealth"])},
+               {pick(["Checkup", "Follow-up", "Cough", "Headache", "Rash", "Back pain", "Fever"])},
+               {pick(["completed"] * 6 + ["scheduled", "cancelled", "no-show"])}
+        FROM generate_series(1, :n)
+    """), {"patients": patients, "providers": providers, "years": years, "n": visits})
+
+    echo("visit diagnoses ...")
+    conn.execute(text("""
+        INSERT INTO visit_diagnosis (visit_id, dx_code)
+        SELECT v.visit_id, 'D' || lpad((1 + floor(random() * :n_dx))::int::text, 4, '0')
+        FROM visit v, generate_series(1, 1 + v.visit_id % 2)
+        ON CONFLICT DO NOTHING
+    """), {"n_dx": N_DIAGNOSES})
+
+    echo("prescriptions ...")
+    conn.execute(text(f"""
+        INSERT INTO prescription (provider_id, visit_id, dose, route, frequency, quantity,
+                                  start_date, end_date)
+        SELECT v.provider_id, v.visit_id,
+               {pick(["5 mg", "10 mg", "20 mg", "250 mg", "500 mg"])},
+               {pick(["oral", "oral", "oral", "IV", "IM", "topical"])},
+               {pick(["once daily", "twice daily", "every 8 hours", "as needed"])},
+               (10 + floor(random() * 80))::int,
+               v.visit_date_time::date,
+               v.visit_date_time::date + (7 + floor(random() * 83))::int
+        FROM visit v
+        WHERE random() < 0.8
+    """))
+    conn.execute(text("""
+        INSERT INTO prescription_medication (rx_id, med_id)
+        SELECT p.rx_id, 1 + floor(random() * (SELECT count(*) FROM medication))::int
+        FROM prescription p, generate_series(1, CASE WHEN random() < 0.2 THEN 2 ELSE 1 END)
+        ON CONFLICT DO NOTHING
+    """))
+
+    echo("allergies ...")
+    conn.execute(text(f"""
+        INSERT INTO patient_allergy (patient_id, substance, reaction, severity)
+        SELECT patient_id,
+               {pick(conflict_substances + EXTRA_SUBSTANCES)},
+               {pick(["Rash", "Hives", "Anaphylaxis", "Nausea", "Swelling"])},
+               {pick(["mild", "moderate", "severe"])}
+        FROM patient
+        WHERE random() < 0.3
+    """))
+    conn.commit()
+
+    echo("allergy conflicts ...")
+    seed_conflict_pairs(conn, CONFLICT_PAIRS)
+
+    for table in TABLES:
+        conn.execute(text(f"ANALYZE {table}"))
+    conn.commit()
+    return {table: conn.execute(text(f"SELECT count(*) FROM {table}")).scalar() for table in TABLES}
+
+
+def time_queries(conn, sql, terms, repeat):
+    """Run every term `repeat` times, return latencies in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        for term in terms:
+            start = time.perf_counter()
+            conn.execute(text(sql), {"q": f"%{term}%", "term": term}).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarize(timings):
+    ordered = sorted(timings)
+    if not ordered:
+        return {"n": 0}
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered), 3),
+        "p50_ms": round(pct(50), 3),
+        "p95_ms": round(pct(95), 3),
+        "p99_ms": round(pct(99), 3),
+    }
+
+
+#
+# Load driver. Every route in server.py has a request builder in ROUTES; a
+# mix says how often each one is picked. Builders get the id ranges from
+# sample_ids() and return (method, path, form, JSONBody or None).
+#
+def new_patient_form(ids):
+    n = random.randrange(10 ** 9)
+    return {"firstname": random.choice(FIRST_NAMES), "lastname": random.choice(LAST_NAMES),
+            "birthdate": f"{random.randint(1940, 2020)}-0{random.randint(1, 9)}-1{random.randint(0, 9)}",
+            "sex": random.choice(["Female", "Male", "Other"]), "phone": f"555-{n % 10000000:07d}",
+            "email": f"load{n}@example.com", "emergency_contact_name": "Load Test",
+            "emergency_contact_phone": "555-0000000"}
+
+
+def search_term():
+    return random.choice(FIRST_NAMES + LAST_NAMES)[:4].lower()
+
+
+class JSONBody(dict):
+    """A request body to send as JSON instead of a form."""
+
+
+def conflict_check_body(ids):
+    return JSONBody(prescriptions=[
+        {"patient_id": random.randint(1, ids["patients"]), "med_ids": random.sample(range(1, 80), 3)}
+        for _ in range(20)
+    ])
+
+
+ROUTES = {
+    "home": lambda ids: ("GET", "/", None),
+    "patient_list": lambda ids: ("GET", "/patient", None),
+    "patient_page": lambda ids: ("GET", "/patient?" + urlencode({"after": random.randint(1, ids["patients"])}), None),
+    "patient_search": lambda ids: ("GET", "/patient?" + urlencode({"q": search_term()}), None),
+    "patient_edit": lambda ids: ("GET", f"/patient/{random.randint(1, ids['patients'])}/edit", None),
+    "patient_new": lambda ids: ("POST", "/patient/new", new_patient_form(ids)),
+    "provider": lambda ids: ("GET", "/provider", None),
+    "visit": lambda ids: ("GET", "/visit", None),
+    "visit_today": lambda ids: ("GET", "/visit?range=today", None),
+    "patient_chart": lambda ids: ("GET", f"/patient/{random.randint(1, ids['patients'])}", None),
+    "api_chart": lambda ids: ("GET", f"/api/v1/patients/{random.randint(1, ids['patients'])}/chart", None),
+    "api_reports": lambda ids: ("GET", "/api/v1/reports", None),
+    "conflict_check": lambda ids: ("POST", "/api/v1/conflicts/check", conflict_check_body(ids)),
+    "api_visits": lambda ids: ("GET", "/api/v1/visits?" + urlencode(
+        {"patient_id": random.randint(1, ids["patients"]), "fields": "visit_id,visit_date_time,status"}), None),
+    "api_prescriptions": lambda ids: ("GET", "/api/v1/prescriptions?fields=rx_id,patient_name,dose&limit=500", None),
+    "api_medications_ndjson": lambda ids: ("GET", "/api/v1/medications?format=ndjson&limit=5000", None),
+    "diagnosis": lambda ids: ("GET", "/diagnosis", None),
+    "prescription": lambda ids: ("GET", "/prescription", None),
+    "medication": lambda ids: ("GET", "/medication", None),
+    "patient_allergy": lambda ids: ("GET", "/patient_allergy", None),
+    "allergy_conflict": lambda ids: ("GET", "/allergy_conflict", None),
+    "report_rx_counts": lambda ids: ("GET", f"/reports/rx_counts?min={random.randint(1, 5)}", None),
+    "report_dx_no_rx": lambda ids: ("POST", "/reports", {"report_type": "diagnosis_no_prescription"}),
+    "report_provider_meds": lambda ids: ("POST", "/reports", {"report_type": "provider_most_medications"}),
+    "report_no_rx_for_dx": lambda ids: ("GET", f"/reports/no_rx_for_dx?dx=D{random.randint(1, N_DIAGNOSES):04d}", None),
+    "metrics": lambda ids: ("GET", "/metrics", None),
+}
+
+MIXES = {
+    "browse": {"home": 2, "patient_list": 10, "patient_page": 10, "patient_edit": 5, "provider": 5,
+               "visit": 5, "diagnosis": 5, "prescription": 5, "medication": 5,
+               "patient_allergy": 5, "allergy_conflict": 5},
+    "search": {"patient_search": 70, "patient_list": 10, "patient_page": 10, "patient_edit": 10},
+    "report": {"report_rx_counts": 30, "report_dx_no_rx": 25, "report_provider_meds": 25,
+               "report_no_rx_for_dx": 20},
+    "write": {"patient_new": 40, "patient_list": 30, "patient_edit": 30},
+    "api": {"patient_chart": 30, "conflict_check": 30, "api_visits": 20, "api_prescriptions": 15,
+            "api_medications_ndjson": 5},
+    # the routes asgi.py serves natively, plus a little of the mounted Flask app
+    "async": {"patient_chart": 20, "api_chart": 20, "api_reports": 10, "report_rx_counts": 10,
+              "report_dx_no_rx": 5, "api_visits": 15, "api_prescriptions": 10, "conflict_check": 5,
+              "patient_list": 5},
+}
+MIXES["mixed"] = {route: 1 for route in ROUTES}
+
+
+def sample_ids(dsn):
+    """Id ranges for the request builders (the generator's ids are contiguous)."""
+    if not dsn:
+        return {"patients": 1000}
+    with create_engine(dsn).connect() as conn:
+        return {"patients": conn.execute(text("SELECT coalesce(max(patient_id), 1) FROM patient")).scalar()}
+
+
+def run_load(base_url, mix, concurrency, duration, ids, warmup=0.0):
+    """
+    Drive `concurrency` clients, one keep-alive connection each, for
+    `warmup` + `duration` seconds. Only requests started after the warm-up
+    count. Returns ({route: [latency ms, ...]}, {route: error count}).
+    """
+    parts = urlsplit(base_url)
+    routes, weights = zip(*MIXES[mix].items())
+    timings = {route: [] for route in routes}
+    errors = {route: 0 for route in routes}
+    lock = threading.Lock()
+    start_at = time.monotonic() + warmup
+    stop_at = start_at + duration
+
+    def connect():
+        return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+    def client():
+        conn = connect()
+        while True:
+            started = time.monotonic()
+            if started >= stop_at:
+                break
+            route = random.choices(routes, weights)[0]
+            method, path, form = ROUTES[route](ids)
+            if isinstance(form, JSONBody):
+                body, headers = json.dumps(form), {"Content-Type": "application/json"}
+            elif form is not None:
+                body, headers = urlencode(form), {"Content-Type": "application/x-www-form-urlencoded"}
+            else:
+                body, headers = None, {}
+            begin = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 400
+            except (OSError, http.client.HTTPException):
+                ok = False
+                conn.close()
+                conn = connect()
+            elapsed = (time.perf_counter() - begin) * 1000
+            if started < start_at:
+                continue
+            with lock:
+                if ok:
+                    timings[route].append(elapsed)
+                else:
+                    errors[route] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return timings, errors
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def load_results(timings, errors, duration, **meta):
+    routes = {route: dict(summarize(samples), errors=errors[route], rps=round(len(samples) / duration, 2))
+              for route, samples in timings.items()}
+    everything = [t for samples in timings.values() for t in samples]
+    return {
+        "meta": dict(meta, duration_s=duration, commit=git_commit(),
+                     finished_at=datetime.now(timezone.utc).isoformat(timespec="seconds")),
+        "total": dict(summarize(everything), errors=sum(errors.values()),
+                      rps=round(len(everything) / duration, 2)),
+        "routes": routes,
+    }
+
+
+def print_results(results):
+    click.echo(f"{'route':24}{'n':>8}{'err':>6}{'rps':>9}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for route, r in sorted(results["routes"].items()) + [("TOTAL", results["total"])]:
+        if not r["n"]:
+            click.echo(f"{route:24}{0:>8}{r['errors']:>6}")
+            continue
+        click.echo(f"{route:24}{r['n']:>8}{r['errors']:>6}{r['rps']:>9}"
+                   f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--dsn", required=True, help="scratch database, the bench schema is dropped and recreated")
+@click.option("--rows", default=1_000_000, show_default=True)
+@click.option("--repeat", default=5, show_default=True)
+@click.option("--output", type=click.Path(), help="also write the results as JSON")
+@click.option("--keep", is_flag=True, help="leave the bench schema behind")
+def search(dsn, rows, repeat, output, keep):
+    """Patient search: LIKE table scan vs. the pg_trgm GIN index."""
+    engine = bench_engine(dsn)
+    with engine.connect() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.commit()
+
+        click.echo(f"generating {rows} patients ...")
+        create_patients(conn, rows)
+
+        click.echo("timing LIKE scan ...")
+        before = summarize(time_queries(conn, LIKE_SQL, SEARCH_TERMS, repeat))
+
+        click.echo("building trigram index ...")
+        start = time.perf_counter()
+        conn.execute(text(f"""
+            CREATE INDEX patient_search_trgm_idx
+                ON patient USING gin (({PATIENT_SEARCH_EXPR}) gin_trgm_ops)
+        """))
+        conn.execute(text("ANALYZE patient"))
+        conn.commit()
+        index_build_s = round(time.perf_counter() - start, 2)
+
+        click.echo("timing trigram search ...")
+        after = summarize(time_queries(conn, TRGM_SQL, SEARCH_TERMS, repeat))
+
+        if not keep:
+            conn.execute(text(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE"))
+            conn.commit()
+
+    results = {"rows": rows, "terms": SEARCH_TERMS, "index_build_s": index_build_s,
+               "like": before, "trgm": after}
+    click.echo(f"{'':8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name in ("like", "trgm"):
+        r = results[name]
+        click.echo(f"{name:8}{r['mean_ms']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+    click.echo(f"index build: {index_build_s}s")
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+@cli.command()
+@click.option("--dsn", required=True, help="scratch database to create the project tables in")
+@click.option("--patients", default=10_000, show_default=True,
+              help="scale; the other tables are sized from it, ~12 rows per patient in total")
+@click.option("--years", default=3, show_default=True, help="how far back visits go")
+@click.option("--seed", default=0.42, show_default=True, help="setseed() value, same seed = same data")
+@click.option("--reset", is_flag=True, help="drop the project tables first")
+@click.option("--no-migrate", is_flag=True, help="skip server.py's migrations (indexes, report views)")
+def generate(dsn, patients, years, seed, reset, no_migrate):
+    """Create the project tables and fill them with synthetic data."""
+    # write hooks fired while seeding (report refresh) go to the same database
+    create_app({"DATABASE_URI": dsn})
+    engine = create_engine(dsn)
+    with engine.connect() as conn:
+        if reset:
+            for table in TABLES:
+                conn.execute(text(f"DROP TABLE IF EXISTS {table} CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+        for stmt in SCHEMA:
+            conn.execute(text(stmt))
+        conn.commit()
+
+        start = time.perf_counter()
+        counts = generate_data(conn, patients, years, seed, echo=click.echo)
+        if not no_migrate:
+            click.echo("migrations ...")
+            migrate(conn)
+        click.echo(f"done in {time.perf_counter() - start:.1f}s")
+    for table in reversed(TABLES):
+        click.echo(f"  {table:26}{counts[table]:>12}")
+    click.echo(f"  {'total':26}{sum(counts.values()):>12}")
+
+
+@cli.command()
+@click.option("--url", default="http://localhost:8111", show_default=True)
+@click.option("--dsn", help="the server's database, to sample valid ids from")
+@click.option("--mix", type=click.Choice(sorted(MIXES)), default="mixed", show_default=True)
+@click.option("--concurrency", default=16, show_default=True)
+@click.option("--duration", default=30.0, show_default=True, help="seconds measured")
+@click.option("--warmup", default=5.0, show_default=True, help="seconds before measuring")
+@click.option("--output", type=click.Path(), help="also write the results as JSON")
+def load(url, dsn, mix, concurrency, duration, warmup, output):
+    """Drive a running server with a request mix; report latency and throughput."""
+    timings, errors = run_load(url, mix, concurrency, duration, sample_ids(dsn), warmup)
+    results = load_results(timings, errors, duration, url=url, mix=mix, concurrency=concurrency)
+    print_results(results)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+# parameters for the registered statements that take any
+STATEMENT_PARAMS = {
+    "patient_edit": lambda ids: {"pid": random.randint(1, ids["patients"])},
+    "no_rx_for_dx": lambda ids: {"dx": "D0001", "pattern": "%D0001%"},
+}
+
+
+def time_statement(run, repeat):
+    """Latencies (ms) of `repeat` calls, and the bytes one call's result holds on to."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    rows = run()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    return timings, held
+
+
+@cli.command()
+@click.option("--dsn", required=True, help="a generated database (see generate)")
+@click.option("--query", "names", multiple=True, type=click.Choice(sorted(QUERIES)),
+              help="only these statements (default: all)")
+@click.option("--repeat", default=50, show_default=True)
+@click.option("--output", type=click.Path(), help="also write the results as JSON")
+def statements(dsn, names, repeat, output):
+    """
+    The registered statements the old way (text() per call, rows copied into
+    dicts) vs. PREPARE once + EXECUTE, rows as records.
+    """
+    app = create_app({"DATABASE_URI": dsn, "PREPARED_STATEMENTS": True})
+    ids = sample_ids(dsn)
+    results = {}
+    click.echo(f"{'statement':24}{'rows':>8}{'text p50':>10}{'prep p50':>10}{'%':>8}"
+               f"{'dict KiB':>10}{'rec KiB':>10}")
+    with app.app_context(), create_engine(dsn).connect() as conn:
+        for name in names or sorted(QUERIES):
+            q = QUERIES[name]
+            params = STATEMENT_PARAMS.get(name, lambda ids: {})(ids)
+            fields = q.record._fields
+
+            def as_dicts():
+                return [dict(zip(fields, row)) for row in conn.execute(text(q.sql), params)]
+
+            def as_records():
+                return q.fetch(params, conn)
+
+            n_rows = len(as_records())    # also prepares it
+            old, old_bytes = time_statement(as_dicts, repeat)
+            new, new_bytes = time_statement(as_records, repeat)
+            conn.rollback()
+            before, after = summarize(old), summarize(new)
+            results[name] = {"rows": n_rows, "text": dict(before, held_bytes=old_bytes),
+                             "prepared": dict(after, held_bytes=new_bytes)}
+            change = (after["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0.0
+            click.echo(f"{name:24}{n_rows:>8}{before['p50_ms']:>10}{after['p50_ms']:>10}{change:>+8.1f}"
+                       f"{old_bytes / 1024:>10.1f}{new_bytes / 1024:>10.1f}")
+    if output:
+        with open(output, "w") as f:
+            json.dump({"meta": {"repeat": repeat, "commit": git_commit()}, "statements": results}, f, indent=2)
+
+
+def partition_queries(today):
+    """name -> (sql, params): the date-bounded shapes of /visit and the reports, and one that isn't."""
+    day = datetime.combine(today, datetime.min.time())
+    last_year = {"period_from": today - timedelta(days=365), "period_to": today + timedelta(days=1)}
+    return {
+        "visit_last_30_days": (
+            VISIT_PAGE_SQL.format(where="WHERE visit_date_time >= :start AND visit_date_time < :end",
+                                  order="DESC"),
+            {"start": day - timedelta(days=30), "end": day + timedelta(days=1), "limit": 51}),
+        "visit_page_5_years_back": (
+            VISIT_PAGE_SQL.format(where="""
+                WHERE (visit_date_time, visit_id) < (:at, :id) AND visit_date_time <= :at
+            """, order="DESC"),
+            {"at": day - timedelta(days=5 * 365), "id": 2 ** 31 - 1, "limit": 51}),
+        "rx_counts_last_year": (
+            f"SELECT * FROM ({report_sql('report_rx_counts_mv', period=True)}) AS r "
+            "WHERE rx_count >= 1 ORDER BY rx_count DESC, patient_name",
+            last_year),
+        "provider_meds_last_year": (
+            f"SELECT * FROM ({report_sql('report_provider_meds_mv', period=True)}) AS r ORDER BY count DESC",
+            last_year),
+        "dx_no_rx_last_90_days": (
+            f"SELECT * FROM ({report_sql('report_dx_no_rx_mv', period=True)}) AS r ORDER BY patient_name",
+            {"period_from": today - timedelta(days=90), "period_to": today + timedelta(days=1)}),
+        "rx_counts_all_time": (
+            f"SELECT * FROM ({report_sql('report_rx_counts_mv')}) AS r "
+            "WHERE rx_count >= 1 ORDER BY rx_count DESC, patient_name",
+            {}),
+    }
+
+
+def scanned_tables(plan):
+    """visit/prescription tables and partitions the EXPLAIN (FORMAT JSON) plan node `plan` reads."""
+    found = set()
+    name = plan.get("Relation Name") or ""
+    if re.fullmatch(r"(visit|prescription)(_y\d{4}|_default)?", name):
+        found.add(name)
+    for child in plan.get("Plans", []):
+        found |= scanned_tables(child)
+    return found
+
+
+def time_partition_queries(conn, repeat):
+    results = {}
+    for name, (sql, params) in partition_queries(date.today()).items():
+        plan = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql), params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(text(sql), params).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        conn.rollback()
+        results[name] = dict(summarize(timings), scanned=sorted(scanned_tables(plan[0]["Plan"])))
+    return results
+
+
+@cli.command()
+@click.option("--dsn", required=True,
+              help="a database from generate --years 10; its tables are partitioned in place")
+@click.option("--repeat", default=20, show_default=True)
+@click.option("--output", type=click.Path(), help="also write the results as JSON")
+def partitions(dsn, repeat, output):
+    """
+    Date-bounded queries on the plain tables, then again after
+    partition-tables: latency, and how many visit/prescription partitions
+    each plan reads.
+    """
+    create_app({"DATABASE_URI": dsn})
+    with create_engine(dsn).connect() as conn:
+        if is_partitioned(conn, "visit"):
+            raise click.ClickException("already partitioned; run generate --reset --years 10 first")
+        click.echo("plain tables ...")
+        before = time_partition_queries(conn, repeat)
+        click.echo("partition-tables ...")
+        partition_tables(conn, echo=click.echo)
+        after = time_partition_queries(conn, repeat)
+    click.echo(f"{'query':26}{'p50 ms':>10}{'after':>10}{'%':>8}{'tables':>8}{'after':>8}")
+    for name in before:
+        old, new = before[name], after[name]
+        change = (new["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100 if old["p50_ms"] else 0.0
+        click.echo(f"{name:26}{old['p50_ms']:>10}{new['p50_ms']:>10}{change:>+8.1f}"
+                   f"{len(old['scanned']):>8}{len(new['scanned']):>8}")
+    if output:
+        with open(output, "w") as f:
+            json.dump({"meta": {"repeat": repeat, "commit": git_commit()},
+                       "before": before, "after": after}, f, indent=2)
+
+
+@cli.command()
+@click.argument("baseline", type=click.File())
+@click.argument("candidate", type=click.File())
+@click.option("--threshold", default=10.0, show_default=True,
+              help="percent; a bigger p95 increase or throughput drop is a regression")
+def compare(baseline, candidate, threshold):
+    """Compare two load results, exit status 1 on a regression."""
+    before, after = json.load(baseline), json.load(candidate)
+
+    def change(old, new):
+        return (new - old) / old * 100 if old else 0.0
+
+    rows = [(route, before["routes"].get(route), r) for route, r in sorted(after["routes"].items())]
+    rows.append(("TOTAL", before["total"], after["total"]))
+    regressions = []
+    click.echo(f"{'route':24}{'p95 before':>12}{'p95 after':>12}{'%':>8}"
+               f"{'rps before':>12}{'rps after':>12}{'%':>8}")
+    for route, old, new in rows:
+        if not old or not old["n"] or not new["n"]:
+            continue
+        p95 = change(old["p95_ms"], new["p95_ms"])
+        rps = change(old["rps"], new["rps"])
+        flag = ""
+        if p95 > threshold or rps < -threshold:
+            regressions.append(route)
+            flag = "  <- regression"
+        click.echo(f"{route:24}{old['p95_ms']:>12}{new['p95_ms']:>12}{p95:>+8.1f}"
+                   f"{old['rps']:>12}{new['rps']:>12}{rps:>+8.1f}{flag}")
+    if regressions:
+        click.echo(f"{len(regressions)} regression(s) over {threshold}%")
+        raise SystemExit(1)
+
+
+SERVER_MODES = {
+    "thread": lambda host, port: ["python", "server.py", "--threaded", host, str(port)],
+    "asgi": lambda host, port: ["python", "asgi.py", host, str(port)],
+}
+
+
+def wait_for_server(url, timeout=30.0):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request("GET", "/metrics")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+    raise click.ClickException(f"server at {url} did not come up")
+
+
+@cli.command()
+@click.option("--dsn", required=True, help="database both servers use (DATABASE_URI)")
+@click.option("--mix", type=click.Choice(sorted(MIXES)), default="async", show_default=True)
+@click.option("--concurrency", default=500, show_default=True)
+@click.option("--duration", default=30.0, show_default=True, help="seconds measured per mode")
+@click.option("--warmup", default=5.0, show_default=True)
+@click.option("--port", default=8311, show_default=True)
+@click.option("--output", type=click.Path(), help="also write {mode: results} as JSON")
+def modes(dsn, mix, concurrency, duration, warmup, port, output):
+    """Thread mode vs. ASGI mode: start each server in turn and run the same load."""
+    ids = sample_ids(dsn)
+    env = dict(os.environ, DATABASE_URI=dsn)
+    url = f"http://127.0.0.1:{port}"
+    everything = {}
+    for mode, command in SERVER_MODES.items():
+        click.echo(f"-- {mode} mode")
+        proc = subprocess.Popen(command("127.0.0.1", port), env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            wait_for_server(url)
+            timings, errors = run_load(url, mix, concurrency, duration, ids, warmup)
+        finally:
+            proc.terminate()
+            proc.wait()
+        everything[mode] = load_results(timings, errors, duration, url=url, mix=mix,
+                                        concurrency=concurrency, mode=mode)
+        print_results(everything[mode])
+    thread, asgi = everything["thread"]["total"], everything["asgi"]["total"]
+    if thread["n"] and asgi["n"]:
+        click.echo(f"asgi vs thread: rps {asgi['rps'] / thread['rps']:.2f}x, "
+                   f"p95 {asgi['p95_ms']} ms vs {thread['p95_ms']} ms")
+    if output:
+        with open(output, "w") as f:
+            json.dump(everything, f, indent=2)
+
+
+PG_DIR = os.path.join(tempfile.gettempdir(), "ehr-bench-pg")
+
+
+@cli.command("pg-start")
+@click.option("--dir", "data_dir", default=PG_DIR, show_default=True)
+@click.option("--port", default=55432, show_default=True)
+@click.option("--db", default="ehr_bench", show_default=True)
+def pg_start(data_dir, port, db):
+    """Start a throwaway local PostgreSQL cluster (needs initdb and pg_ctl on PATH)."""
+    for tool in ("initdb", "pg_ctl", "createdb"):
+        if shutil.which(tool) is None:
+            raise click.ClickException(f"{tool} not found on PATH")
+    if not os.path.exists(os.path.join(data_dir, "PG_VERSION")):
+        subprocess.run(["initdb", "-D", data_dir, "-A", "trust"], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(["pg_ctl", "-D", data_dir, "-l", os.path.join(data_dir, "server.log"), "-w",
+                    "-o", f"-p {port} -k {data_dir}", "start"], check=True)
+    # fails harmlessly when the database is already there
+    subprocess.run(["createdb", "-h", data_dir, "-p", str(port), db])
+    click.echo(f"postgresql://localhost:{port}/{db}")
+
+
+@cli.command("pg-replica")
+@click.option("--primary-dir", default=PG_DIR, show_default=True)
+@click.option("--primary-port", default=55432, show_default=True)
+@click.option("--dir", "data_dir", default=PG_DIR + "-replica", show_default=True)
+@click.option("--port", default=55433, show_default=True)
+@click.option("--db", default="ehr_bench", show_default=True)
+def pg_replica(primary_dir, primary_port, data_dir, port, db):
+    """Start a streaming replica of the pg-start cluster, for DB_REPLICA_URIS."""
+    for tool in ("pg_basebackup", "pg_ctl"):
+        if shutil.which(tool) is None:
+            raise click.ClickException(f"{tool} not found on PATH")
+    if not os.path.exists(os.path.join(data_dir, "PG_VERSION")):
+        # -R writes standby.signal and the primary_conninfo to follow
+        subprocess.run(["pg_basebackup", "-h", primary_dir, "-p", str(primary_port), "-D", data_dir,
+                        "-R", "-X", "stream"], check=True)
+    subprocess.run(["pg_ctl", "-D", data_dir, "-l", os.path.join(data_dir, "server.log"), "-w",
+                    "-o", f"-p {port} -k {data_dir}", "start"], check=True)
+    click.echo(f"postgresql://localhost:{port}/{db}")
+
+
+@cli.command("pg-stop")
+@click.option("--dir", "data_dir", default=PG_DIR, show_default=True)
+@click.option("--remove", is_flag=True, help="also delete the data directory")
+def pg_stop(data_dir, remove):
+    """Stop the cluster started by pg-start."""
+    subprocess.run(["pg_ctl", "-D", data_dir, "-m", "fast", "stop"], check=True)
+    if remove:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    cli()
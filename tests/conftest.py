@@ -0,0 +1,65 @@
+"""
+Most tests need no database: the app gets a DATABASE_URI nothing listens
+on, so they pass only on paths that never query (or that handle the
+outage). Tests marked `db` run against the scratch PostgreSQL in
+TEST_DATABASE_URI, filled beforehand with e.g.
+
+    python bench.py generate --dsn $TEST_DATABASE_URI --patients 1000 --reset
+
+and are skipped without it. They add rows of their own; never point
+TEST_DATABASE_URI at a database with real data.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+NO_DATABASE = "postgresql://ehr@127.0.0.1:1/unreachable"
+TEST_DATABASE_URI = os.environ.get("TEST_DATABASE_URI")
+
+# background threads would outlive the test that started them
+TEST_CONFIG = {"JOB_WORKERS": 0, "REPORT_REFRESH_INTERVAL": 0, "CACHE_BACKEND": "memory",
+               "DB_REPLICA_URIS": [], "DB_POOL_TIMEOUT": 2}
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "db: needs the PostgreSQL in TEST_DATABASE_URI")
+
+
+def pytest_collection_modifyitems(config, items):
+    if TEST_DATABASE_URI:
+        return
+    skip = pytest.mark.skip(reason="TEST_DATABASE_URI is not set")
+    for item in items:
+        if "db" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def app():
+    return server.create_app(dict(TEST_CONFIG, DATABASE_URI=NO_DATABASE))
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db_app():
+    return server.create_app(dict(TEST_CONFIG, DATABASE_URI=TEST_DATABASE_URI))
+
+
+@pytest.fixture
+def db_client(db_app):
+    return db_app.test_client()
+
+
+@pytest.fixture
+def db_conn(db_app):
+    with server.get_engine().connect() as conn:
+        yield conn
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+from sqlalchemy import text
+
+import server
+
+
+def test_unknown_resource(client):
+    assert client.get("/api/v1/nothing").status_code == 404
+
+
+@pytest.mark.db
+def test_ndjson_streams_every_row(db_client):
+    pool = server.get_engine().pool
+    checked_out = pool.checkedout()
+    response = db_client.get("/api/v1/patients?format=ndjson&fields=patient_id,lastname&limit=50")
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(rows) == 50
+    assert set(rows[0]) == {"patient_id", "lastname"}
+    response.close()
+    assert pool.checkedout() == checked_out
+
+
+@pytest.mark.db
+def test_chart_etag(db_client, db_conn):
+    pid = db_conn.execute(text("SELECT min(patient_id) FROM patient")).scalar()
+    response = db_client.get(f"/api/v1/patients/{pid}/chart")
+    assert response.status_code == 200
+    assert response.json["patient"]["patient_id"] == pid
+    etag = response.headers["ETag"]
+
+    for path in (f"/api/v1/patients/{pid}/chart", f"/patient/{pid}"):
+        cached = db_client.get(path, headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        assert cached.data == b""
+    assert db_client.get(f"/patient/{pid}", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+@pytest.mark.db
+def test_chart_of_unknown_patient(db_client):
+    assert db_client.get("/api/v1/patients/0/chart").status_code == 404
+
+
+def test_conflict_index_follows_changes():
+    index = server.ConflictIndex()
+    for med_id, drug_name in ((1, "Amoxicillin"), (2, "Ibuprofen"), (3, "Metformin")):
+        index.apply({"table": "medication", "op": "INSERT", "row": {"med_id": med_id, "drug_name": drug_name}})
+    index.apply({"table": "patient_allergy", "op": "INSERT",
+                 "row": {"patient_id": 7, "allergy_id": 70, "substance": "Penicillin", "severity": "Severe"}})
+
+    assert index.check(7, [1, 2, 3]) == [{
+        "med_id": 1, "drug_name": "Amoxicillin", "drug_class": "penicillins",
+        "allergy_id": 70, "substance": "Penicillin", "severity": "Severe",
+    }]
+    assert index.check(8, [1, 2, 3]) == []
+
+    # the allergy changes substance, then a drug is renamed into a class
+    index.apply({"table": "patient_allergy", "op": "UPDATE",
+                 "row": {"patient_id": 7, "allergy_id": 70, "substance": "NSAIDs", "severity": "Mild"},
+                 "old": {"patient_id": 7, "allergy_id": 70}})
+    index.apply({"table": "medication", "op": "UPDATE", "row": {"med_id": 3, "drug_name": "Naproxen"}})
+    assert [(c["med_id"], c["drug_class"]) for c in index.check(7, [1, 2, 3])] == [(2, "nsaids"), (3, "nsaids")]
+
+    index.apply({"table": "patient_allergy", "op": "DELETE",
+                 "row": {"patient_id": 7, "allergy_id": 70}})
+    assert index.check(7, [1, 2, 3]) == []
+    assert 7 not in index.allergies
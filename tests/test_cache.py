@@ -0,0 +1,88 @@
+import json
+import os
+import pickle
+import select
+
+import pytest
+from sqlalchemy import text
+
+import server
+
+
+def entry_size(value):
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def test_memory_cache_evicts_least_recently_used():
+    value = [("x" * 100,)]
+    cache = server.MemoryCache(3 * entry_size(value))
+    for key in "abc":
+        cache.set(key, value, 60, {"patient"})
+    cache.get("a")                       # b is now the oldest
+    cache.set("d", value, 60, {"patient"})
+
+    assert cache.get("b") is server.MISS
+    assert [cache.get(key) for key in "acd"] == [value] * 3
+    assert cache.info()["evictions"] == 1
+    assert cache.info()["bytes"] == 3 * entry_size(value)
+
+
+def test_memory_cache_skips_values_over_the_cap():
+    cache = server.MemoryCache(64)
+    cache.set("big", ["x" * 100], 60, set())
+    assert cache.get("big") is server.MISS
+    assert cache.info()["entries"] == 0
+
+
+def test_memory_cache_ttl_and_invalidation():
+    cache = server.MemoryCache(1 << 20)
+    cache.set("expired", [(1,)], -1, {"patient"})
+    cache.set("patients", [(2,)], 60, {"patient"})
+    cache.set("meds", [(3,)], 60, {"medication"})
+    assert cache.get("expired") is server.MISS
+
+    cache.invalidate({"patient"})
+    assert cache.get("patients") is server.MISS
+    assert cache.get("meds") == [(3,)]
+
+
+def test_redis_tag_sets_expire_after_their_entries(app):
+    fakeredis = pytest.importorskip("fakeredis")
+    cache = server.RedisCache(fakeredis.FakeRedis())
+    longest = max(app.config["CACHE_TTLS"].values())
+    cache.set("patients", [(1,)], 30, {"patient"})
+    assert cache.get("patients") == [(1,)]
+    assert cache.client.ttl(cache.prefix + "tag:patient") == longest
+
+    cache.invalidate({"patient"})
+    assert cache.get("patients") is server.MISS
+    assert not cache.client.exists(cache.prefix + "tag:patient")
+
+
+def test_apply_invalidation_from_another_process(app, monkeypatch):
+    cache = server.MemoryCache(1 << 20)
+    monkeypatch.setattr(server, "cache", cache)
+    cache.set("a", [(1,)], 60, {"patient"})
+    cache.set("b", [(2,)], 60, {"medication"})
+
+    server.apply_invalidation({"pid": os.getpid(), "tables": ["patient"]})
+    assert cache.get("a") == [(1,)]
+
+    server.apply_invalidation({"pid": os.getpid() + 1, "tables": ["patient"]})
+    assert cache.get("a") is server.MISS
+    assert cache.get("b") == [(2,)]
+
+
+@pytest.mark.db
+def test_invalidation_is_broadcast(db_app, db_conn, monkeypatch):
+    monkeypatch.setattr(server, "cache", server.MemoryCache(1 << 20))
+    db_conn.execution_options(isolation_level="AUTOCOMMIT")
+    db_conn.execute(text(f"LISTEN {server.CACHE_CHANNEL}"))
+    pg = db_conn.connection.driver_connection
+
+    server.tables_changed("allergyconflict")
+
+    assert select.select([pg], [], [], 5) != ([], [], [])
+    pg.poll()
+    change = json.loads(pg.notifies.pop(0).payload)
+    assert change == {"pid": os.getpid(), "tables": ["allergyconflict"]}
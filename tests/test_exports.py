@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import text
+
+import server
+
+
+def test_export_job_rejects_unknown_exports():
+    job = server.Job(1, "export", {}, 1, 1)
+    with pytest.raises(ValueError):
+        server.export_job(job, name="pg_shadow", fmt="csv", filters={})
+
+
+def test_unknown_export_format(client):
+    assert client.get("/prescription?format=xlsx").status_code == 400
+
+
+@pytest.mark.db
+@pytest.mark.parametrize("path, header", [
+    ("/prescription?format=csv", "rx_id,provider_id"),
+    ("/medication?format=csv", "med_id,drug_name"),
+    ("/reports/rx_counts?format=csv&min=2&from=2020-01-01", "patient_id,patient_name,rx_count"),
+    ("/reports?report_type=provider_most_medications&format=csv&live=1", "provider_id,provider_name"),
+])
+def test_streamed_exports(db_client, path, header):
+    response = db_client.get(path)
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).startswith(header)
+    response.close()
+    assert server.get_engine().pool.checkedout() == 0
+
+
+@pytest.mark.db
+def test_background_export_job_stores_no_sql(db_client, db_app, db_conn, monkeypatch, tmp_path):
+    monkeypatch.setitem(db_app.config, "EXPORT_DIR", str(tmp_path))
+    response = db_client.get("/reports/rx_counts?format=csv&background=1&min=2&to=2030-12-31")
+    assert response.status_code == 303
+    job_id = int(response.headers["Location"].rstrip("/").rsplit("/", 1)[1])
+    params = db_conn.execute(text("SELECT params FROM job WHERE job_id = :id"), {"id": job_id}).scalar()
+    db_conn.execute(text("DELETE FROM job WHERE job_id = :id"), {"id": job_id})
+    db_conn.commit()
+    assert params == {"name": "rx_counts", "fmt": "csv", "replica": False,
+                      "filters": {"min": 2, "live": False, "to": "2030-12-31"}}
+
+    result = server.export_job(server.Job(job_id, "export", params, 1, 1), **params)
+    assert result["file"] == "rx_counts.csv"
+    assert (tmp_path / str(job_id) / "rx_counts.csv").read_text().startswith("patient_id,patient_name,rx_count")
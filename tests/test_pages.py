@@ -0,0 +1,234 @@
+import gzip
+import html
+import os
+import re
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+import server
+
+
+@pytest.mark.parametrize("path", ["/", "/another", "/static/app.css"])
+def test_static_pages_never_touch_the_database(client, monkeypatch, path):
+    monkeypatch.setattr(server, "conflict_listener", None)
+    checkouts = server.pool_stats["checkouts"]
+    assert client.get(path).status_code == 200
+    assert server.pool_stats["checkouts"] == checkouts
+    assert server.conflict_listener is None
+
+
+def test_server_timing_and_metrics(client):
+    timing = client.get("/").headers["Server-Timing"]
+    assert timing.startswith('db;dur=0.0;desc="0 queries", app;dur=')
+    body = client.get("/metrics").get_data(as_text=True)
+    assert 'ehr_http_requests_total{route="index",method="GET",status="200"}' in body
+    assert 'ehr_http_request_duration_seconds_bucket{route="index",le="+Inf"}' in body
+
+
+def test_slow_query_log_redacts_parameters():
+    assert server.redact({"pid": 7, "q": "Ada"}) == {"pid": "<redacted>", "q": "<redacted>"}
+    assert server.redact([{"pid": 7}, {"pid": 8}]) == "<2 parameter sets redacted>"
+
+
+@pytest.mark.db
+def test_server_timing_counts_queries(db_client):
+    timing = db_client.get("/provider").headers["Server-Timing"]
+    assert 'desc="0 queries"' not in timing
+    body = db_client.get("/metrics").get_data(as_text=True)
+    assert 'ehr_db_queries_total{route="provider"}' in body
+
+
+def visit_ids(response):
+    return [int(i) for i in re.findall(r"<tr>\s*<td>(\d+)</td>", response.get_data(as_text=True))]
+
+
+def pager_link(response, label):
+    match = re.search(r'<a href="([^"]+)">[^<]*' + label, response.get_data(as_text=True))
+    return html.unescape(match.group(1)) if match else None
+
+
+def test_visit_filters():
+    wednesday = date(2024, 5, 15)
+    where, params, filters = server.visit_filters(
+        MultiDict({"provider": "3", "status": " Completed ", "range": "week"}), today=wednesday)
+    assert filters == {"provider": 3, "status": "Completed", "range": "week"}
+    assert params["start"] == datetime(2024, 5, 13)
+    assert params["end"] == datetime(2024, 5, 20)
+    assert where == ["provider_id = :provider", "status = :status",
+                     "visit_date_time >= :start", "visit_date_time < :end"]
+
+    where, params, filters = server.visit_filters(MultiDict({"to": "2024-01-31", "patient": "x"}))
+    assert filters == {"to": "2024-01-31"}
+    assert where == ["visit_date_time < :end"] and params["end"] == datetime(2024, 2, 1)
+
+
+def test_visit_cursor():
+    assert server.visit_cursor("2024-05-15T09:30:00,42") == (datetime(2024, 5, 15, 9, 30), 42)
+
+
+@pytest.mark.db
+def test_visit_keyset_paging(db_client, db_conn):
+    newest = [row[0] for row in db_conn.execute(text(
+        "SELECT visit_id FROM visit ORDER BY visit_date_time DESC, visit_id DESC LIMIT 10"))]
+
+    first = db_client.get("/visit?limit=5")
+    assert visit_ids(first) == newest[:5]
+    assert pager_link(first, "Newer") is None
+
+    second = db_client.get(pager_link(first, "Older"))
+    assert visit_ids(second) == newest[5:]
+
+    back = db_client.get(pager_link(second, "Newer"))
+    assert visit_ids(back) == newest[:5]
+
+
+def test_a_write_keeps_the_browser_on_the_primary(app):
+    app.config["DB_REPLICA_URIS"] = ["postgresql://ehr@127.0.0.1:1/replica"]
+    with app.test_request_context("/patient_allergy", method="POST"):
+        server.tables_changed("patient_allergy")
+        cookie = server.set_primary_cookie(app.response_class()).headers["Set-Cookie"]
+    assert cookie.startswith(server.PRIMARY_COOKIE + "=1;")
+    with app.test_request_context("/patient", headers={"Cookie": server.PRIMARY_COOKIE + "=1"}):
+        assert server.pick_replica() is None
+
+
+@pytest.mark.db
+def test_read_only_routes_use_a_healthy_replica(db_app, db_client):
+    # the test database stands in for a replica: never in recovery, so 0 lag
+    db_app.config.update(DB_REPLICA_URIS=[os.environ["TEST_DATABASE_URI"]], REPLICA_CHECK_INTERVAL=3600)
+    replica = server.ensure_replicas().replicas[0]
+    replica.check(db_app.config["REPLICA_MAX_LAG"])
+    assert replica.healthy
+
+    reads = replica.reads
+    assert db_client.get("/patient").status_code == 200
+    assert replica.reads == reads + 1
+
+    db_client.set_cookie(server.PRIMARY_COOKIE, "1")
+    assert db_client.get("/patient").status_code == 200
+    assert replica.reads == reads + 1
+
+
+def test_pages_are_compressed_and_conditional(app, client):
+    app.config["COMPRESS_MIN_BYTES"] = 0
+    plain = client.get("/")
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.data) == plain.data
+
+    etag = response.headers["ETag"]
+    assert etag.startswith("W/")
+    again = client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.data == b""
+
+
+def test_row_fragments_are_cached_by_version(app):
+    row = {"patient_id": 7, "full_name": "Ada Lovelace"}
+    with app.test_request_context("/patient"):
+        first = server.row_fragment("patient", row, 7, 100)
+        row["full_name"] = "Ada King"
+        assert server.row_fragment("patient", row, 7, 100) == first
+        assert "Ada King" in server.row_fragment("patient", row, 7, 101)
+        assert "Ada King" in server.row_fragment("patient", row, 7, None)
+    info = server.get_fragment_cache().info()
+    assert (info["entries"], info["hits"], info["misses"]) == (2, 1, 2)
+
+
+def test_fragment_cache_evicts_least_recently_used():
+    cache = server.FragmentCache(2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    cache.get("a")
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+
+
+@pytest.fixture
+def flaky_job(db_conn, monkeypatch):
+    """A job kind that fails on its first run, and a helper to queue one."""
+    calls = []
+
+    def flaky(job):
+        calls.append(job.attempts)
+        job.progress("working")
+        if len(calls) == 1:
+            raise RuntimeError("try again")
+        return {"attempts": job.attempts}
+
+    monkeypatch.setitem(server.JOB_KINDS, "test_flaky", flaky)
+    job_ids = []
+
+    def enqueue():
+        job_ids.append(server.enqueue_job("test_flaky", max_attempts=2))
+        first_in_line(db_conn, job_ids[-1])
+        return job_ids[-1]
+
+    yield enqueue
+    db_conn.execute(text("DELETE FROM job WHERE job_id = ANY(:ids)"), {"ids": job_ids})
+    db_conn.commit()
+
+
+def first_in_line(conn, job_id):
+    # ahead of any job other tests left in the queue
+    conn.execute(text("UPDATE job SET run_after = '2000-01-01' WHERE job_id = :id"), {"id": job_id})
+    conn.commit()
+
+
+def job_json(client, job_id):
+    return client.get(f"/jobs/{job_id}?format=json").json
+
+
+@pytest.mark.db
+def test_failed_job_is_retried_then_cancelled_and_retried_by_hand(db_client, db_conn, flaky_job):
+    runner = server.JobRunner(1, 0, 60)
+    job_id = flaky_job()
+
+    with server.get_engine().connect() as conn:
+        runner.execute(runner.claim(conn))
+    job = job_json(db_client, job_id)
+    assert (job["status"], job["attempts"], job["error"]) == ("queued", 1, "try again")
+
+    assert db_client.post(f"/admin/jobs/{job_id}/cancel").status_code == 303
+    assert job_json(db_client, job_id)["status"] == "cancelled"
+
+    assert db_client.post(f"/admin/jobs/{job_id}/retry").status_code == 303
+    job = job_json(db_client, job_id)
+    assert (job["status"], job["attempts"]) == ("queued", 0)
+
+    first_in_line(db_conn, job_id)
+    with server.get_engine().connect() as conn:
+        runner.execute(runner.claim(conn))
+    job = job_json(db_client, job_id)
+    assert (job["status"], job["result"], job["error"]) == ("done", {"attempts": 1}, None)
+
+
+@pytest.mark.db
+def test_cancelling_a_running_job_stops_it_at_its_next_progress(db_client, flaky_job):
+    runner = server.JobRunner(1, 0, 60)
+    job_id = flaky_job()
+    with server.get_engine().connect() as conn:
+        job = runner.claim(conn)
+        assert job.id == job_id
+        runner.running[job.id] = job
+
+        db_client.post(f"/admin/jobs/{job_id}/cancel")
+        assert job_json(db_client, job_id)["status"] == "running"
+        runner.heartbeat(conn)
+    assert job.cancelled.is_set()
+
+    runner.execute(job)
+    assert job_json(db_client, job_id)["status"] == "cancelled"
+
+
+@pytest.mark.parametrize("path", [
+    "/patient", "/provider", "/visit", "/patient_allergy", "/diagnosis", "/prescription",
+    "/medication", "/allergy_conflict", "/reports/no_rx_for_dx?dx=J45",
+])
+def test_database_outage_is_a_503(client, path):
+    assert client.get(path).status_code == 503
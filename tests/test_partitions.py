@@ -0,0 +1,145 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import exc, text
+
+import server
+
+# the partitioned tables and the ones referencing them, cut down to their keys
+SCHEMA = """
+    CREATE TABLE visit (
+        visit_id serial PRIMARY KEY,
+        patient_id int NOT NULL,
+        visit_date_time timestamp NOT NULL
+    );
+    CREATE TABLE visit_diagnosis (
+        visit_id int NOT NULL REFERENCES visit ON DELETE CASCADE,
+        diagnosis_id int NOT NULL,
+        PRIMARY KEY (visit_id, diagnosis_id)
+    );
+    CREATE TABLE prescription (
+        rx_id serial PRIMARY KEY,
+        visit_id int REFERENCES visit ON DELETE CASCADE,
+        start_date date
+    );
+    CREATE TABLE prescription_medication (
+        rx_id int NOT NULL REFERENCES prescription ON DELETE CASCADE,
+        med_id int NOT NULL,
+        PRIMARY KEY (rx_id, med_id)
+    );
+    INSERT INTO visit VALUES (1, 1, '2019-03-01 10:00'), (2, 1, '2020-03-01 10:00'), (3, 2, '2020-06-01 09:00');
+    INSERT INTO visit_diagnosis VALUES (1, 10), (2, 20), (3, 30);
+    INSERT INTO prescription VALUES (1, 1, '2019-03-01'), (2, 2, '2020-03-01'), (3, 3, NULL);
+    INSERT INTO prescription_medication VALUES (1, 100), (2, 200), (3, 300);
+    SELECT setval('visit_visit_id_seq', 3), setval('prescription_rx_id_seq', 3);
+"""
+
+
+@pytest.fixture
+def partitioned(db_conn):
+    """SCHEMA partitioned in a scratch schema; everything is rolled back afterwards."""
+    db_conn.exec_driver_sql("CREATE SCHEMA partition_test; SET LOCAL search_path TO partition_test, public")
+    db_conn.exec_driver_sql(SCHEMA)
+    for stmt in server.PARTITION_KEY_FUNCTIONS:
+        db_conn.execute(text(stmt))
+    db_conn.copied = {table: server.partition_table(db_conn, table, column, echo=lambda line: None)
+                      for table, column in server.PARTITIONED_TABLES.items()}
+    yield db_conn
+    db_conn.rollback()
+
+
+def ids(conn, sql):
+    return conn.execute(text(sql)).scalars().all()
+
+
+@pytest.mark.db
+def test_partition_table(partitioned):
+    conn = partitioned
+    assert conn.copied == {"visit": 3, "prescription": 3}
+    assert server.is_partitioned(conn, "visit") and server.is_partitioned(conn, "prescription")
+    assert {2019, 2020, date.today().year} <= set(server.partitions(conn, "visit"))
+
+    where = dict(conn.execute(text("SELECT visit_id, CAST(tableoid AS regclass) FROM visit")).all())
+    assert where == {1: "visit_y2019", 2: "visit_y2020", 3: "visit_y2020"}
+    assert conn.execute(text("SELECT CAST(tableoid AS regclass) FROM prescription WHERE rx_id = 3")
+                        ).scalar() == "prescription_default"
+    # the serial's sequence carries on where it was
+    assert conn.execute(text("INSERT INTO visit (patient_id, visit_date_time) VALUES (1, now()) "
+                             "RETURNING visit_id")).scalar() == 4
+
+
+@pytest.mark.db
+def test_foreign_keys_reference_the_keys_tables(partitioned):
+    conn = partitioned
+    assert ids(conn, "SELECT visit_id FROM visit_keys ORDER BY 1") == [1, 2, 3]
+    for sql in ("INSERT INTO visit_diagnosis VALUES (99, 1)",
+                "INSERT INTO prescription_medication VALUES (99, 1)",
+                "UPDATE prescription SET visit_id = 99 WHERE rx_id = 2"):
+        with pytest.raises(exc.IntegrityError, match="foreign key"), conn.begin_nested():
+            conn.execute(text(sql))
+
+    # ON DELETE CASCADE, down to the prescription lines
+    conn.execute(text("DELETE FROM visit WHERE visit_id = 2"))
+    assert ids(conn, "SELECT visit_id FROM visit_keys ORDER BY 1") == [1, 3]
+    assert ids(conn, "SELECT visit_id FROM visit_diagnosis ORDER BY 1") == [1, 3]
+    assert ids(conn, "SELECT rx_id FROM prescription ORDER BY 1") == [1, 3]
+    assert ids(conn, "SELECT rx_id FROM prescription_medication ORDER BY 1") == [1, 3]
+
+
+@pytest.mark.db
+def test_ids_stay_unique_and_fixed(partitioned):
+    conn = partitioned
+    # another year's partition would take it, but visit_keys doesn't
+    with pytest.raises(exc.IntegrityError, match="visit_keys_pkey"), conn.begin_nested():
+        conn.execute(text("INSERT INTO visit VALUES (1, 1, '2024-01-01')"))
+    with pytest.raises(exc.IntegrityError, match="key column"), conn.begin_nested():
+        conn.execute(text("UPDATE visit SET visit_id = 4 WHERE visit_id = 3"))
+    with pytest.raises(exc.IntegrityError, match="key column"), conn.begin_nested():
+        conn.execute(text("UPDATE prescription SET rx_id = 4 WHERE rx_id = 3"))
+
+
+@pytest.mark.db
+def test_moving_a_row_to_another_year_keeps_what_references_it(partitioned):
+    conn = partitioned
+    conn.execute(text("UPDATE visit SET visit_date_time = '2021-01-05 08:00' WHERE visit_id = 1"))
+    conn.execute(text("UPDATE prescription SET start_date = '2021-01-05' WHERE rx_id = 1"))
+    assert conn.execute(text("SELECT CAST(tableoid AS regclass) FROM visit WHERE visit_id = 1")
+                        ).scalar() == "visit_y2021"
+    assert ids(conn, "SELECT visit_id FROM visit_keys ORDER BY 1") == [1, 2, 3]
+    assert ids(conn, "SELECT visit_id FROM visit_diagnosis ORDER BY 1") == [1, 2, 3]
+    assert ids(conn, "SELECT rx_id FROM prescription_medication ORDER BY 1") == [1, 2, 3]
+
+
+@pytest.mark.db
+def test_detach_partitions(partitioned):
+    conn = partitioned
+    echo = []
+    assert server.detach_partitions(conn, 2020, echo=echo.append) == ["visit_y2019", "prescription_y2019"]
+    assert ids(conn, "SELECT visit_id FROM visit ORDER BY 1") == [2, 3]
+    assert ids(conn, "SELECT visit_id FROM visit_y2019") == [1]
+    assert 2019 not in server.partitions(conn, "visit")
+    # what referenced the detached rows went with them
+    assert ids(conn, "SELECT visit_id FROM visit_keys ORDER BY 1") == [2, 3]
+    assert ids(conn, "SELECT visit_id FROM visit_diagnosis ORDER BY 1") == [2, 3]
+    assert ids(conn, "SELECT visit_id FROM visit_diagnosis_y2019") == [1]
+    assert ids(conn, "SELECT rx_id FROM prescription_medication ORDER BY 1") == [2, 3]
+    assert ids(conn, "SELECT rx_id FROM prescription_medication_y2019") == [1]
+    assert ids(conn, "SELECT rx_id FROM prescription_y2019") == [1]
+    assert echo == ["  visit_diagnosis_y2019: 1 rows of visit_diagnosis",
+                    "  prescription_medication_y2019: 1 rows of prescription_medication"]
+
+    # rx 3, undated, would stay live in prescription_default
+    conn.execute(text("UPDATE prescription SET start_date = '2020-06-01' WHERE rx_id = 3"))
+    assert server.detach_partitions(conn, 2021, drop=True) == ["visit_y2020", "prescription_y2020"]
+    assert conn.execute(text("SELECT to_regclass('visit_y2020')")).scalar() is None
+    assert ids(conn, "SELECT visit_id FROM visit") == []
+    assert ids(conn, "SELECT visit_id FROM visit_diagnosis") == []
+
+
+@pytest.mark.db
+def test_detach_refuses_to_orphan_live_rows(partitioned):
+    conn = partitioned
+    # rx 2 starts in 2020 but belongs to the 2019 visit
+    conn.execute(text("UPDATE prescription SET visit_id = 1 WHERE rx_id = 2"))
+    with pytest.raises(ValueError, match="1 rows of prescription"):
+        server.detach_partitions(conn, 2020)
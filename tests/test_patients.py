@@ -0,0 +1,120 @@
+import io
+import json
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+import server
+
+NEW_PATIENT = {
+    "firstname": "Ada", "birthdate": "1990-04-01", "sex": "F", "phone": "555-0100",
+    "email": "ada@example.com", "emergency_contact_name": "Bo", "emergency_contact_phone": "555-0101",
+}
+
+
+def test_new_patient_form(client):
+    assert client.get("/patient/new").status_code == 200
+
+
+def test_new_patient_missing_fields(client):
+    response = client.post("/patient/new", data={"firstname": "Ada"})
+    assert response.status_code == 400
+    assert b"lastname" in response.data and b"birthdate" in response.data
+
+
+def test_new_patient_database_outage(client):
+    assert client.post("/patient/new", data=dict(NEW_PATIENT, lastname="Lovelace")).status_code == 503
+
+
+def test_validate_patient():
+    values, errors = server.validate_patient(dict(NEW_PATIENT, lastname=" Lovelace ", birthdate="04/01/1990"))
+    assert values["lastname"] == "Lovelace"
+    assert errors == ["birthdate must be YYYY-MM-DD"]
+    assert server.validate_patient(dict(NEW_PATIENT, lastname="Lovelace"))[1] == []
+
+
+def test_batch_rejects_fields_outside_the_editable_ones():
+    operations, errors = server.parse_patient_batch({"operations": [
+        {"op": "update", "patient_id": 1, "version": 1, "set": {"birthdate": "1990-01-01"}},
+    ]})
+    assert len(errors) == 1 and "birthdate can't be changed" in errors[0]
+
+
+def unique_name():
+    return "Test" + uuid.uuid4().hex[:12]
+
+
+def patient_count(conn, lastname):
+    return conn.execute(text("SELECT count(*) FROM patient WHERE lastname = :ln"), {"ln": lastname}).scalar()
+
+
+@pytest.mark.db
+def test_create_patient(db_client, db_conn):
+    lastname = unique_name()
+    response = db_client.post("/patient/new", data=dict(NEW_PATIENT, lastname=lastname))
+    assert response.status_code == 302
+    assert patient_count(db_conn, lastname) == 1
+
+
+@pytest.mark.db
+def test_import_patients_upload(db_client, db_conn):
+    lastname = unique_name()
+    rows = "firstname,lastname,birthdate,sex,phone,email,emergency_contact_name,emergency_contact_phone\n"
+    rows += f"Ada,{lastname},1990-04-01,F,555-0100,ada@example.com,Bo,555-0101\n"
+    rows += f"Bea,{lastname},not a date,F,555-0102,bea@example.com,Cy,555-0103\n"
+    response = db_client.post("/patient/import", data={"file": (io.BytesIO(rows.encode()), "patients.csv")},
+                              content_type="multipart/form-data")
+    assert response.status_code == 200
+    assert patient_count(db_conn, lastname) == 1
+
+    # the raw-body variant answers with the summary; the same row again is a duplicate
+    response = db_client.post("/patient/import", data=rows.encode(), content_type="text/csv")
+    assert response.get_json()["inserted"] == 0
+    assert response.get_json()["duplicates"] == 1
+    assert response.get_json()["errors"][0]["line"] == 3
+
+
+@pytest.mark.db
+def test_import_patients_skips_duplicates_within_the_file(db_client, db_conn):
+    lastname = unique_name()
+    rows = "firstname,lastname,birthdate,sex,phone,email,emergency_contact_name,emergency_contact_phone\n"
+    rows += f"Ada,{lastname},1990-04-01,F,555-0100,ada@example.com,Bo,555-0101\n" * 2
+    rows += f"Ada,{lastname},1990-04-01,F,555-0100,ada@example.org,Bo,555-0101\n" * 2
+    summary = db_client.post("/patient/import", data=rows.encode(), content_type="text/csv").get_json()
+    assert (summary["inserted"], summary["duplicates"]) == (2, 2)
+    assert patient_count(db_conn, lastname) == 2
+
+
+@pytest.mark.db
+def test_import_patients_command(db_app, db_conn, tmp_path):
+    lastname = unique_name()
+    path = tmp_path / "patients.ndjson"
+    path.write_text(json.dumps(dict(NEW_PATIENT, lastname=lastname)) + "\n")
+    result = db_app.test_cli_runner().invoke(args=["import-patients", str(path)])
+    assert result.exit_code == 0, result.output
+    assert patient_count(db_conn, lastname) == 1
+
+
+@pytest.mark.db
+def test_patient_update_conflict(db_client, db_conn):
+    lastname = unique_name()
+    db_client.post("/patient/new", data=dict(NEW_PATIENT, lastname=lastname))
+    pid, version = db_conn.execute(text("SELECT patient_id, version FROM patient WHERE lastname = :ln"),
+                                   {"ln": lastname}).one()
+    db_conn.rollback()
+    form = {"firstname": "Ada", "lastname": lastname, "version": version}
+    assert db_client.post(f"/patient/{pid}/update", data=form).status_code == 302
+    assert db_client.post(f"/patient/{pid}/update", data=form).status_code == 409
+
+
+@pytest.mark.db
+def test_full_patient_export(db_client, db_conn):
+    total = db_conn.execute(text("SELECT count(*) FROM patient")).scalar()
+    pool = server.get_engine().pool
+    checked_out = pool.checkedout()
+    response = db_client.get("/patient?export=1")
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).count('/edit"') >= total
+    response.close()
+    assert pool.checkedout() == checked_out
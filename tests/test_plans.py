@@ -0,0 +1,52 @@
+"""
+The check-plans checks as tests. On the small scratch database the
+planner rightly prefers sequential scans, so the db tests turn them off:
+a query still planned with a full scan then has no index it can use.
+"""
+import pytest
+from sqlalchemy import text
+
+import server
+
+
+def test_seq_scans():
+    plan = {"Node Type": "Nested Loop", "Plans": [
+        {"Node Type": "Seq Scan", "Relation Name": "visit"},
+        {"Node Type": "Index Scan", "Relation Name": "prescription", "Index Cond": "(visit_id = 1)"},
+        {"Node Type": "Index Scan", "Relation Name": "patient_allergy"},
+        {"Node Type": "Seq Scan", "Relation Name": "diagnosis"},
+    ]}
+    assert server.seq_scans(plan) == ["visit", "patient_allergy"]
+
+
+def test_no_rx_for_dx_form_needs_no_database(client):
+    checkouts = server.pool_stats["checkouts"]
+    response = client.get("/reports/no_rx_for_dx")
+    assert response.status_code == 200
+    assert server.pool_stats["checkouts"] == checkouts
+
+
+@pytest.mark.db
+def test_fk_indexes_and_plans(db_app, db_conn):
+    db_conn.execute(text("SET enable_seqscan = off"))
+    results = server.run_plan_checks(db_conn)
+    db_conn.rollback()
+    assert [line for line, failed in results if failed] == []
+    assert len(results) == len(server.PLAN_CHECKS)
+
+
+@pytest.mark.db
+def test_plan_checks_notice_a_missing_index(db_app, db_conn):
+    db_conn.execute(text("SET enable_seqscan = off"))
+    db_conn.execute(text("DROP INDEX patient_allergy_patient_id_idx"))
+    failed = [line for line, failed in server.run_plan_checks(db_conn) if failed]
+    db_conn.rollback()
+    assert failed == ["SEQSCAN  patient_chart: patient_allergy"]
+
+
+@pytest.mark.db
+def test_no_rx_for_dx(db_client, db_conn):
+    dx_code = db_conn.execute(text("SELECT dx_code FROM visit_diagnosis LIMIT 1")).scalar()
+    response = db_client.get("/reports/no_rx_for_dx", query_string={"dx": dx_code})
+    assert response.status_code == 200
+    assert b"Could not run the report" not in response.data
@@ -0,0 +1,104 @@
+import pytest
+from sqlalchemy import text
+
+import server
+
+
+@pytest.mark.db
+def test_reprepare_keeps_earlier_work(db_app, db_conn):
+    query = server.PRESCRIPTION_LIST
+    expected = query.rows(db_conn)
+    db_conn.rollback()
+
+    db_conn.execute(text("CREATE TEMP TABLE earlier_work (n int)"))
+    db_conn.execute(text("INSERT INTO earlier_work VALUES (1)"))
+    # the server forgets the statement, this connection still thinks it's prepared
+    db_conn.exec_driver_sql("DEALLOCATE ALL")
+    assert query.name in db_conn.connection.info["prepared"]
+
+    assert query.rows(db_conn) == expected
+    assert db_conn.execute(text("SELECT n FROM earlier_work")).scalar() == 1
+    db_conn.rollback()
+
+
+@pytest.mark.db
+def test_pages_skip_prescriptions_without_provider_or_visit(db_app, db_client, db_conn):
+    rx_id = db_conn.execute(text("""
+        INSERT INTO prescription (provider_id, visit_id, dose) VALUES (NULL, NULL, '1 tab')
+        RETURNING rx_id
+    """)).scalar()
+    med_id = db_conn.execute(text("SELECT min(med_id) FROM medication")).scalar()
+    db_conn.execute(text("INSERT INTO prescription_medication VALUES (:rx, :med)"),
+                    {"rx": rx_id, "med": med_id})
+    db_conn.commit()
+    try:
+        assert rx_id not in [row[0] for row in server.PRESCRIPTION_LIST.rows(db_conn)]
+        assert rx_id not in [row[4] for row in server.MEDICATION_LIST.rows(db_conn)]
+        db_conn.rollback()
+        listed = db_client.get(f"/api/v1/prescriptions?limit=1000&after={rx_id - 1}").get_json()
+        assert listed["data"][0]["rx_id"] == rx_id
+    finally:
+        db_conn.rollback()
+        db_conn.execute(text("DELETE FROM prescription WHERE rx_id = :rx"), {"rx": rx_id})
+        db_conn.commit()
+
+
+@pytest.mark.db
+def test_failed_statements_leave_no_start_times(db_app, db_conn):
+    for _ in range(3):
+        with pytest.raises(server.exc.ProgrammingError):
+            db_conn.execute(text("SELECT no_such_column FROM patient"))
+        db_conn.rollback()
+    db_conn.execute(text("SELECT 1"))
+    assert db_conn.info["query_start"] == {}
+
+
+def read_model(conn, rx_id):
+    row = conn.execute(text("SELECT provider_id, visit_id, patient_name FROM rx_read WHERE rx_id = :rx"),
+                       {"rx": rx_id}).one_or_none()
+    return row and tuple(row)
+
+
+@pytest.mark.db
+def test_triggers_keep_the_read_model_in_sync(db_app, db_conn):
+    patient_id, provider_id = db_conn.execute(text("""
+        SELECT (SELECT min(patient_id) FROM patient), (SELECT min(provider_id) FROM provider)
+    """)).one()
+    visit_id = db_conn.execute(text("""
+        INSERT INTO visit (patient_id, provider_id, visit_date_time) VALUES (:pt, :pr, now())
+        RETURNING visit_id
+    """), {"pt": patient_id, "pr": provider_id}).scalar()
+    rx_id = db_conn.execute(text("""
+        INSERT INTO prescription (provider_id, visit_id, dose) VALUES (:pr, :v, '1 tab') RETURNING rx_id
+    """), {"pr": provider_id, "v": visit_id}).scalar()
+    db_conn.execute(text("UPDATE patient SET firstname = 'Resynced' WHERE patient_id = :pt"),
+                    {"pt": patient_id})
+    assert read_model(db_conn, rx_id)[0:2] == (provider_id, visit_id)
+    assert read_model(db_conn, rx_id)[2].startswith("Resynced ")
+
+    db_conn.execute(text("UPDATE visit SET provider_id = NULL WHERE visit_id = :v"), {"v": visit_id})
+    db_conn.execute(text("DELETE FROM visit WHERE visit_id = :v"), {"v": visit_id})
+    assert read_model(db_conn, rx_id) is None
+    assert server.check_read_model(db_conn) == {"rx_read": [], "rx_med_read": []}
+
+
+@pytest.mark.db
+def test_check_read_model_finds_and_fixes_drift(db_app, db_conn):
+    rx_id = db_conn.execute(text("SELECT min(rx_id) FROM rx_read")).scalar()
+    db_conn.execute(text("UPDATE rx_read SET dose = 'drifted' WHERE rx_id = :rx"), {"rx": rx_id})
+    db_conn.commit()
+    try:
+        assert server.check_read_model(db_conn) == {"rx_read": [rx_id], "rx_med_read": []}
+        assert server.check_read_model(db_conn, fix=True) == {"rx_read": [rx_id], "rx_med_read": []}
+        assert server.check_read_model(db_conn) == {"rx_read": [], "rx_med_read": []}
+    finally:
+        db_conn.rollback()
+        db_conn.execute(text("SELECT rx_read_sync(ARRAY[CAST(:rx AS bigint)])"), {"rx": rx_id})
+        db_conn.commit()
+
+
+@pytest.mark.db
+def test_read_model_sync_locks_any_bigint(db_app, db_conn):
+    # the lock keys used to be int: anything above 2^31 failed
+    db_conn.execute(text("SELECT rx_read_sync(ARRAY[CAST(3000000000 AS bigint)])"))
+    db_conn.rollback()
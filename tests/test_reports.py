@@ -0,0 +1,45 @@
+from datetime import date
+
+import pytest
+
+import server
+
+
+def test_report_period():
+    assert server.report_period({}) == (None, {})
+    assert server.report_period({"from": "someday"}) == (None, {})
+    params, dates = server.report_period({"from": "2024-01-01", "to": "2024-12-31"})
+    assert params == {"period_from": date(2024, 1, 1), "period_to": date(2025, 1, 1)}
+    assert dates == {"from": "2024-01-01", "to": "2024-12-31"}
+
+
+def test_report_period_open_ended():
+    params, dates = server.report_period({"to": "9999-12-31"})
+    assert params == {"period_from": date.min, "period_to": date.max}
+    assert dates == {"to": "9999-12-31"}
+
+
+@pytest.mark.db
+@pytest.mark.parametrize("query", ["to=9999-12-31", "from=2020-01-01&to=2024-06-30"])
+def test_dated_reports_on_asyncpg(db_app, monkeypatch, query):
+    pytest.importorskip("asyncpg")
+    testclient = pytest.importorskip("starlette.testclient")
+    asgi = pytest.importorskip("asgi")
+    monkeypatch.setattr(server, "ensure_conflict_index", lambda: None)
+    with testclient.TestClient(asgi.app) as client:
+        response = client.get("/api/v1/reports?" + query)
+    assert response.status_code == 200
+    assert set(response.json()) == set(server.REPORT_TYPES)
+
+
+@pytest.mark.db
+def test_report_type_from_the_query_string_on_asgi(db_app, monkeypatch):
+    pytest.importorskip("asyncpg")
+    testclient = pytest.importorskip("starlette.testclient")
+    asgi = pytest.importorskip("asgi")
+    monkeypatch.setattr(server, "ensure_conflict_index", lambda: None)
+    report_type = next(iter(server.REPORT_TYPES))
+    with testclient.TestClient(asgi.app) as client:
+        empty = client.get("/reports").text
+        shown = client.get("/reports?report_type=" + report_type).text
+    assert "<tr" in shown and "<tr" not in empty
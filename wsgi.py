@@ -0,0 +1,147 @@
+"""
+Production launcher: server.py's app under gunicorn, with several worker
+processes of several threads each.
+
+    pip install -r requirements-prod.txt          # plus requirements-asgi.txt for --asgi
+    python wsgi.py --workers 4 --threads 8 0.0.0.0 8111
+
+The app is imported once in the master (--preload) and the workers are
+forked from it, so they boot instantly and share its memory pages. Nothing
+at import talks to the database; if the master did open connections anyway,
+server.after_fork() drops them in each worker so no pooled connection is
+ever used by two processes.
+
+Signals to the master (its pid is in --pid):
+
+    HUP     graceful reload: new workers are started, then the old ones
+            finish their in-flight requests and exit; no request is dropped.
+            With --preload the app code is the master's, so a HUP picks up
+            configuration changes, not code changes; to deploy new code
+            send USR2 (starts a new master next to the old one) and then
+            QUIT to the old master, or run with --no-preload.
+    TTIN/TTOU   one worker more / less
+    TERM    graceful shutdown
+
+--max-requests recycles a worker after that many requests (plus up to
+--max-requests-jitter, so they don't all restart at once), which bounds any
+slow memory growth. Each worker has its own connection pool plus one
+connection of its own, held by the listener that keeps its conflict index
+and memory cache current, so keep
+
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW + 1)
+
+under the database's max_connections. The job runner in each worker takes
+its connections from the pool: one for its polling loop and one per
+running job (JOB_WORKERS). Keep threads + JOB_WORKERS + 1 at or below
+DB_POOL_SIZE + DB_MAX_OVERFLOW or requests will queue for connections.
+"""
+import multiprocessing
+
+import click
+from gunicorn.app.base import BaseApplication
+
+import server
+
+
+def post_fork(arbiter, worker):
+    server.after_fork()
+
+
+def worker_exit(arbiter, worker):
+    # give the connections back to PostgreSQL instead of letting them time out
+    if server.engine is not None:
+        server.engine.dispose()
+
+
+class Launcher(BaseApplication):
+    """gunicorn with its settings from a dict instead of a config file."""
+
+    def __init__(self, load, options):
+        self.load_app = load
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.load_app()
+
+
+def load_wsgi():
+    app = server.create_app()
+    # with --preload this runs once in the master: the workers fork with
+    # every template already compiled
+    server.compile_templates()
+    return app
+
+
+def load_asgi():
+    import asgi
+
+    return asgi.app
+
+
+@click.command()
+@click.option("--workers", default=multiprocessing.cpu_count() * 2 + 1, show_default="2 * cores + 1")
+@click.option("--threads", default=4, show_default=True, help="threads per worker")
+@click.option("--asgi", "use_asgi", is_flag=True, help="serve asgi.py with uvicorn workers instead")
+@click.option("--preload/--no-preload", default=True, show_default=True,
+              help="import the app once in the master and fork the workers from it")
+@click.option("--max-requests", default=10000, show_default=True,
+              help="recycle a worker after this many requests (0 = never)")
+@click.option("--max-requests-jitter", default=1000, show_default=True)
+@click.option("--timeout", default=60, show_default=True, help="seconds before a stuck worker is killed")
+@click.option("--graceful-timeout", default=30, show_default=True,
+              help="seconds workers get to finish in-flight requests on reload or shutdown")
+@click.option("--pid", "pidfile", type=click.Path(), help="write the master's pid here (for kill -HUP)")
+@click.argument("HOST", default="0.0.0.0")
+@click.argument("PORT", default=8111, type=int)
+def run(workers, threads, use_asgi, preload, max_requests, max_requests_jitter, timeout,
+        graceful_timeout, pidfile, host, port):
+    """
+    Run the production server using:
+
+        python wsgi.py --workers 4 --threads 8
+
+    Show the help text using:
+
+        python wsgi.py --help
+    """
+    config = server.app.config
+    if config["DB_POOL"] != "null":
+        pool = config["DB_POOL_SIZE"] + config["DB_MAX_OVERFLOW"]
+        # + the listener's connection (conflict index, cache invalidation)
+        per_worker = pool + 1
+        print("at most %d database connections (%d workers x %d)" % (workers * per_worker, workers, per_worker))
+        # the job runner's loop and each of its jobs hold a pooled connection
+        jobs = config["JOB_WORKERS"] + 1 if config["JOB_WORKERS"] else 0
+        if not use_asgi and threads + jobs > pool:
+            print("warning: %d threads and %d job connections per worker but only %d connections in each pool"
+                  % (threads, jobs, pool))
+
+    options = {
+        "bind": "%s:%d" % (host, port),
+        "workers": workers,
+        "preload_app": preload,
+        "max_requests": max_requests,
+        "max_requests_jitter": max_requests_jitter,
+        "timeout": timeout,
+        "graceful_timeout": graceful_timeout,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+        "pidfile": pidfile,
+    }
+    if use_asgi:
+        options["worker_class"] = "uvicorn_worker.UvicornWorker"
+    else:
+        options["worker_class"] = "gthread"
+        options["threads"] = threads
+    print("running on %s:%d (%d workers, %s)" % (host, port, workers,
+                                                  "asgi" if use_asgi else "%d threads each" % threads))
+    Launcher(load_asgi if use_asgi else load_wsgi, options).run()
+
+
+if __name__ == "__main__":
+    run()